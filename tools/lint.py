@@ -6,15 +6,36 @@
 '''
 # TODO(wang16): Only show error for the lines do changed in the changeset
 
+import argparse
+import multiprocessing
 import os
 import os.path
 import re
+import subprocess
 import sys
 
+from multiprocessing.pool import ThreadPool
+
 from utils import GitExe, GetCommandOutput, TryAddDepotToolsToPythonPath
 
 PYTHON_EXTS = ['.py']
 JS_EXTS = ['.js']
+COMMON_DIR_PREFIX = 'common'
+CPPLINT_PREFETCH_THREADS = 4
+# cpplint errors are ignored for files ending with IGNORED_ERROR_SUFFIXES,
+# and the missing header guard error for IGNORED_HEADER_GUARD_SUFFIXES.
+IGNORED_ERROR_SUFFIXES = ('resource.h',)
+IGNORED_HEADER_GUARD_SUFFIXES = ('messages.h',)
+if sys.platform.startswith('win'):
+  PYLINT_CMD = ['pylint.bat']
+  GJSLINT_CMD = ['gjslint.exe']
+else:
+  PYLINT_CMD = ['pylint']
+  GJSLINT_CMD = ['gjslint']
+GJSLINT_CMD += ['--strict', '--nojsdoc', '--max_line_length', '100',
+                '--unix_mode']
+# pylint F0401: Unable to import module.
+PYLINT_IMPORT_ERROR_REGEX = re.compile(r'^F0401:', re.M)
 
 def find_depot_tools_in_path():
   paths = os.getenv('PATH').split(os.path.pathsep)
@@ -24,36 +45,19 @@ def find_depot_tools_in_path():
   return None
 
 def repo_is_dirty():
-  return GetCommandOutput([GitExe(), 'diff', 'HEAD']).strip() != ''
+  # git diff --quiet only reports through its exit code, so no patch is
+  # generated for the work tree.
+  return subprocess.call([GitExe(), 'diff', '--quiet', 'HEAD']) != 0
 
 def get_tracking_remote():
-  branch = [GitExe(), 'branch', '-vv', '-a']
-  # The output of git branch -vv will be in format
-  # * <branch>     <hash> [<remote>: ahead <n>, behind <m>] <subject>
-  #   <branch>     <hash> <subject>
-  output = GetCommandOutput(branch)
-  branches = output.split('\n')
-  for branch in branches:
-    # we only need active branch first.
-    if not branch.startswith('*'):
-      continue
-    detail = \
-        branch[1:].strip().split(' ', 1)[1].strip().split(' ', 1)[1].strip()
-    if detail.startswith('['):
-      remote = detail[1:].split(']', 1)[0]
-      remote = remote.split(':', 1)[0].strip()
-      # verify that remotes/branch or branch is a real branch
-      # There is still chance that developer named his commit
-      # as [origin/branch], in this case
-      exists = [\
-          r_branch for r_branch in branches \
-              if r_branch.strip().startswith('remotes/'+remote) or \
-                 r_branch.strip().startswith(remote)]
-      if len(exists) == 0:
-        remote = ''
-    else:
-      remote = ''
-    break
+  upstream = [GitExe(), 'rev-parse', '--abbrev-ref', '--symbolic-full-name',
+              '@{upstream}']
+  try:
+    remote = GetCommandOutput(upstream).strip()
+  except Exception:
+    # The active branch has no tracking branch, or the tracking branch
+    # doesn't exist any more.
+    remote = ''
   if remote == '':
     if repo_is_dirty():
       remote = 'HEAD'
@@ -63,30 +67,65 @@ def get_tracking_remote():
         'will use %s as comparasion base for linting' % remote
   return remote
 
+def iter_nul_records(stream, chunk_size=65536):
+  pending = ''
+  while True:
+    chunk = stream.read(chunk_size)
+    if not chunk:
+      break
+    records = (pending + chunk).split('\0')
+    pending = records.pop()
+    for record in records:
+      yield record
+  if pending:
+    yield pending
+
 # return pyfiles, others
 def get_change_file_list(base):
-  diff = [GitExe(), 'diff', '--name-only', base]
-  output = GetCommandOutput(diff)
-  changes = [line.strip() for line in output.strip().split('\n')]
+  # The output of git diff --name-status -z will be NUL separated records
+  #   <status>\0<path>\0
+  #   <status><score>\0<old path>\0<new path>\0  (for renames and copies)
+  # Deleted files have nothing left to lint, let git leave them out.
+  diff = [GitExe(), 'diff', '--name-status', '-z', '--diff-filter=d', base]
+  proc = subprocess.Popen(diff, stdout=subprocess.PIPE)
   pyfiles = []
   jsfiles = []
   others = []
-  common_regex = re.compile('common')
+  buckets = dict([(ext, pyfiles) for ext in PYTHON_EXTS] +
+                 [(ext, jsfiles) for ext in JS_EXTS])
   # pylint: disable=W0612
-  for change in changes:
+  records = iter_nul_records(proc.stdout)
+  for status in records:
+    change = next(records)
+    if status[:1] in ('R', 'C'):
+      change = next(records)
     root, ext = os.path.splitext(change)
-    if common_regex.match(os.path.dirname(change)):
+    if os.path.dirname(change).startswith(COMMON_DIR_PREFIX):
       print 'Skip common dir'
       continue
-    if ext.lower() in PYTHON_EXTS:
-      pyfiles.append(change)
-    elif ext.lower() in JS_EXTS:
-      jsfiles.append(change)
-    else:
-      others.append(change)
+    buckets.get(ext.lower(), others).append(change)
+  proc.stdout.close()
+  if proc.wait():
+    raise Exception('%s: exit code %d' % (subprocess.list2cmdline(diff),
+                                          proc.returncode))
   return pyfiles, jsfiles, others
 
-def do_cpp_lint(changeset, args):
+def prefetch_file(filename):
+  try:
+    with open(filename, 'rb') as f:
+      while f.read(65536):
+        pass
+  except IOError:
+    # cpplint will report the unreadable file itself.
+    pass
+
+# (cpplint, cpplint_chromium, gcl) once they are imported and patched.
+_cpplint = None
+
+def _ensure_cpplint():
+  global _cpplint
+  if _cpplint:
+    return _cpplint
   # Try to import cpplint from depot_tools first
   try:
     import cpplint
@@ -105,39 +144,28 @@ def do_cpp_lint(changeset, args):
   origin_error = cpplint.Error
   def MyError(filename, linenum, category, confidence, message):
     # Skip no header guard  error for MSVC generated files.
-    if (filename.endswith('resource.h')):
-      sys.stdout.write('Ignored Error:\n  %s(%s):  %s  [%s] [%d]\n' % (
-          filename, linenum, message, category, confidence))
     # Skip no header guard  error for ipc messages definition,
     # because they will be included multiple times for different macros.
-    elif (filename.endswith('messages.h') and linenum == 0 and
-        category == 'build/header_guard'):
+    if (filename.endswith(IGNORED_ERROR_SUFFIXES) or
+        (linenum == 0 and category == 'build/header_guard' and
+         filename.endswith(IGNORED_HEADER_GUARD_SUFFIXES))):
       sys.stdout.write('Ignored Error:\n  %s(%s):  %s  [%s] [%d]\n' % (
           filename, linenum, message, category, confidence))
     else:
       origin_error(filename, linenum, category, confidence, message)
   cpplint.Error = MyError
 
-  origin_FileInfo = cpplint.FileInfo
-  class MyFileInfo(origin_FileInfo):
-    def RepositoryName(self):
-      ''' Origin FileInfo find the first .git and take it as project root,
-          it's not the case for xwalk, header in xwalk should have guard
-          relevant to root dir of chromium project, which is one level
-          upper of the origin output of RepositoryName.
-      '''
-      return origin_FileInfo.RepositoryName(self)
-
-  cpplint.FileInfo = MyFileInfo
+  _cpplint = (cpplint, cpplint_chromium, gcl)
+  return _cpplint
 
-  print '_____ do cpp lint'
-  if len(changeset) == 0:
-    print 'changeset is empty except python files'
-    return 0
-  # Following code is referencing depot_tools/gcl.py: CMDlint
-  # Process cpplints arguments if any.
-  filenames = cpplint.ParseArguments(args + changeset)
+# (extra_check_functions, white_regex, black_regex) once they are loaded.
+_cpplint_config = None
 
+def _ensure_cpplint_config():
+  global _cpplint_config
+  if _cpplint_config:
+    return _cpplint_config
+  cpplint, cpplint_chromium, gcl = _ensure_cpplint()
   white_list = gcl.GetCodeReviewSetting("LINT_REGEX")
   if not white_list:
     white_list = gcl.DEFAULT_LINT_REGEX
@@ -147,50 +175,94 @@ def do_cpp_lint(changeset, args):
     black_list = gcl.DEFAULT_LINT_IGNORE_REGEX
   black_regex = re.compile(black_list)
   extra_check_functions = [cpplint_chromium.CheckPointerDeclarationWhitespace]
+  _cpplint_config = (extra_check_functions, white_regex, black_regex)
+  return _cpplint_config
+
+def do_cpp_lint(changeset, args):
+  print '_____ do cpp lint'
+  if len(changeset) == 0:
+    print 'changeset is empty except python files'
+    return 0
+  cpplint = _ensure_cpplint()[0]
+  # Following code is referencing depot_tools/gcl.py: CMDlint
+  # Process cpplints arguments if any.
+  filenames = cpplint.ParseArguments(args + changeset)
+
+  extra_check_functions, white_regex, black_regex = _ensure_cpplint_config()
   # pylint: disable=W0212
   cpplint_state = cpplint._cpplint_state
-  for filename in filenames:
-    if white_regex.match(filename):
-      if black_regex.match(filename):
-        print "Ignoring file %s" % filename
+  # Read the files to lint ahead on a few threads, so cpplint finds them in
+  # the OS cache instead of waiting on the disk for each one.
+  to_lint = [filename for filename in filenames
+             if white_regex.match(filename) and
+                not black_regex.match(filename)]
+  prefetch_pool = ThreadPool(CPPLINT_PREFETCH_THREADS)
+  prefetch_pool.map_async(prefetch_file, to_lint)
+  try:
+    for filename in filenames:
+      if white_regex.match(filename):
+        if black_regex.match(filename):
+          print "Ignoring file %s" % filename
+        else:
+          print filename
+          cpplint.ProcessFile(filename, cpplint_state.verbose_level,
+                              extra_check_functions)
       else:
-        print filename
-        cpplint.ProcessFile(filename, cpplint_state.verbose_level,
-                            extra_check_functions)
-    else:
-      print "Skipping file %s" % filename
+        print "Skipping file %s" % filename
+  finally:
+    prefetch_pool.terminate()
+    prefetch_pool.join()
   print "cpplint errors %d\n" % cpplint_state.error_count
   return cpplint_state.error_count
 
+def run_lint_jobs(jobs):
+  ''' Run each (command, cwd) job on a thread pool, the linters share no
+      state between files. Returns (returncode, output) for each job in
+      the same order as jobs.
+  '''
+  def run(job):
+    command, cwd = job
+    try:
+      proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, cwd=cwd)
+    except OSError, e:
+      # The linter itself can't be started.
+      return -1, '%s: %s' % (subprocess.list2cmdline(command), e)
+    output = proc.communicate()[0]
+    return proc.returncode, output.strip()
+  if len(jobs) == 0:
+    return []
+  pool = ThreadPool(min(len(jobs), multiprocessing.cpu_count()))
+  try:
+    return pool.map(run, jobs)
+  finally:
+    pool.close()
+    pool.join()
+
 def do_py_lint(changeset):
   print '_____ do python lint'
-  if sys.platform.startswith('win'):
-    pylint_cmd = ['pylint.bat']
-  else:
-    pylint_cmd = ['pylint']
   _has_import_error = False
   error_count = 0;
+  # The changed paths are relative to the current directory.
+  repo_root = os.getcwd()
+  jobs = []
   for pyfile in changeset:
-    if os.path.exists(pyfile) != True:
-      print "Skipping file %s: File doesn't exist." % pyfile
-      continue
-    py_dir, py_name = os.path.split(os.path.abspath(pyfile))
-    previous_cwd = os.getcwd()
-    os.chdir(py_dir)
-    print 'pylint %s' % pyfile
-    try:
-      output = GetCommandOutput(pylint_cmd + [py_name]).strip()
-      if len(output) > 0:
-        print output
-      else:
-        error_count += 1;
-    except Exception, e:
-      if not _has_import_error and \
-          'F0401:' in [error[:6] for error in str(e).splitlines()]:
+    py_dir, py_name = os.path.split(os.path.join(repo_root, pyfile))
+    jobs.append((PYLINT_CMD + [py_name], py_dir))
+  results = run_lint_jobs(jobs)
+  out_buf = []
+  for pyfile, (returncode, output) in zip(changeset, results):
+    out_buf.append('pylint %s\n' % pyfile)
+    if returncode:
+      if not _has_import_error and PYLINT_IMPORT_ERROR_REGEX.search(output):
         _has_import_error = True
-      print e
+      out_buf.append(output + '\n')
       error_count += 1;
-    os.chdir(previous_cwd)
+    elif len(output) > 0:
+      out_buf.append(output + '\n')
+    else:
+      error_count += 1;
+  sys.stdout.write(''.join(out_buf))
   if _has_import_error:
     print 'You have error for python importing, please check your PYTHONPATH'
   print "pylint errors %d\n" % error_count
@@ -198,31 +270,25 @@ def do_py_lint(changeset):
 
 def do_js_lint(changeset):
   print '\n_____ do JavaScript lint'
-  if sys.platform.startswith('win'):
-    jslint_cmd = ['gjslint.exe']
-  else:
-    jslint_cmd = ['gjslint']
   error_count = 0;
+  # The changed paths are relative to the current directory.
+  repo_root = os.getcwd()
+  jobs = []
   for jsfile in changeset:
-    if os.path.exists(jsfile) != True:
-      print "Skipping file %s: File doesn't exist." % jsfile
-      continue
-    args = ['--strict', '--nojsdoc', '--max_line_length', '100', '--unix_mode']
-    js_dir, js_name = os.path.split(os.path.abspath(jsfile))
-    previous_cwd = os.getcwd()
-    os.chdir(js_dir)
-    print 'jslint %s' % jsfile
-    args.append(js_name)
-    try:
-      output = GetCommandOutput(jslint_cmd + args).strip()
-      if len(output) > 0:
-        print output
-      else:
-        error_count += 1;
-    except Exception, e:
-      print e
+    js_dir, js_name = os.path.split(os.path.join(repo_root, jsfile))
+    jobs.append((GJSLINT_CMD + [js_name], js_dir))
+  results = run_lint_jobs(jobs)
+  out_buf = []
+  for jsfile, (returncode, output) in zip(changeset, results):
+    out_buf.append('jslint %s\n' % jsfile)
+    if returncode:
+      out_buf.append(output + '\n')
+      error_count += 1;
+    elif len(output) > 0:
+      out_buf.append(output + '\n')
+    else:
       error_count += 1;
-    os.chdir(previous_cwd)
+  sys.stdout.write(''.join(out_buf))
   print "jslint errors %d\n" % error_count
   return error_count
 
@@ -230,6 +296,9 @@ def do_lint(base, args):
   if base == None:
     base = get_tracking_remote()
   changes_py, changes_js, changes_others = get_change_file_list(base)
+  if not (changes_py or changes_js or changes_others):
+    print 'No changed files to lint against %s' % base
+    return 0
   total_erros = 0;
   total_erros += do_cpp_lint(changes_others, args)
   total_erros += do_py_lint(changes_py)
@@ -237,32 +306,19 @@ def do_lint(base, args):
   print "The total errors found: %d\n" % total_erros
   return total_erros
 
-from optparse import OptionParser, BadOptionError
-class PassThroughOptionParser(OptionParser):
-  def _process_long_opt(self, rargs, values):
-    try:
-      OptionParser._process_long_opt(self, rargs, values)
-    except BadOptionError, err:
-      self.largs.append(err.opt_str)
-
-  def _process_short_opts(self, rargs, values):
-    try:
-      OptionParser._process_short_opts(self, rargs, values)
-    except BadOptionError, err:
-      self.largs.append(err.opt_str)
-
 def main():
-  option_parser = PassThroughOptionParser()
+  option_parser = argparse.ArgumentParser()
 
-  option_parser.add_option('--base', default=None,
+  option_parser.add_argument('--base', default=None,
       help='The base point to get change set. If not specified,' +
            ' it will choose:\r\n' +
            '  1. Active branch\'s tracking branch if exist\n' +
            '  2. HEAD if current repo is dirty\n' +
            '  3. HEAD~ elsewise')
 
-  options, args = option_parser.parse_args()
-  
+  # Unknown arguments are passed through to cpplint.
+  options, args = option_parser.parse_known_args()
+
   sys.exit(do_lint(options.base, args))
 
 if __name__ == '__main__':